@@ -1,11 +1,20 @@
 # chat/manager.py
 import uuid  # Добавили импорт
-from typing import List, Dict, Any
-from dataclasses import dataclass, asdict
+import asyncio
+import atexit
+import threading
+from typing import List, Dict, Any, Optional
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
 from .storage import ChatStorage
 from pathlib import Path
 
+# Сообщения сохраняются на диск не чаще одного раза за этот интервал (секунды)
+SAVE_DEBOUNCE_INTERVAL = 1.0
+
+# Версия формата файла чата: 2 - сообщения параллельными списками
+CHAT_SCHEMA = 2
+
 @dataclass
 class Message:
     """Класс сообщения"""
@@ -26,28 +35,60 @@ class Chat:
     created_at: str
     updated_at: str
     model_config: Dict[str, Any] = None
+    # Кэш результата to_dict: новые сообщения дописываются в него,
+    # а не пересобираются целиком при каждом сохранении
+    _serialized: Optional[Dict[str, Any]] = field(default=None, init=False, repr=False, compare=False)
     
-    def add_message(self, role: str, content: str):
+    def add_message(self, role: str, content: str) -> Message:
         """Добавляет сообщение в чат"""
-        self.messages.append(Message(role=role, content=content))
+        message = Message(role=role, content=content)
+        self.messages.append(message)
         self.updated_at = datetime.now().isoformat()
+        if self._serialized is not None:
+            self._serialized["roles"].append(message.role)
+            self._serialized["contents"].append(message.content)
+            self._serialized["timestamps"].append(message.timestamp)
+        return message
+    
+    def clear_messages(self):
+        """Удаляет все сообщения чата"""
+        self.messages = []
+        self._serialized = None
     
     def to_dict(self) -> Dict[str, Any]:
-        """Сериализация в словарь"""
-        return {
-            "id": self.id,
-            "title": self.title,
-            "messages": [{"role": m.role, "content": m.content, "timestamp": m.timestamp} for m in self.messages],
-            "created_at": self.created_at,
-            "updated_at": self.updated_at,
-            "model_config": self.model_config,
-        }
+        """
+        Сериализация в словарь.
+        Сообщения хранятся параллельными списками (schema 2),
+        без повторения ключей role/content/timestamp в каждом сообщении
+        """
+        if self._serialized is None:
+            self._serialized = {
+                "schema": CHAT_SCHEMA,
+                "roles": [m.role for m in self.messages],
+                "contents": [m.content for m in self.messages],
+                "timestamps": [m.timestamp for m in self.messages],
+            }
+        # Скалярные поля обновляются всегда: они могут меняться напрямую
+        self._serialized.update(
+            id=self.id,
+            title=self.title,
+            created_at=self.created_at,
+            updated_at=self.updated_at,
+            model_config=self.model_config,
+        )
+        return self._serialized
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> "Chat":
-        """Десериализация из словаря"""
-        messages = [Message(**m) for m in data.get("messages", [])]
-        return cls(
+        """Десериализация из словаря (schema 2 или старый формат со списком сообщений)"""
+        if data.get("schema", 1) >= 2:
+            messages = [
+                Message(role=role, content=content, timestamp=timestamp)
+                for role, content, timestamp in zip(data["roles"], data["contents"], data["timestamps"])
+            ]
+        else:
+            messages = [Message(**m) for m in data.get("messages", [])]
+        chat = cls(
             id=data["id"],
             title=data["title"],
             messages=messages,
@@ -55,6 +96,10 @@ class Chat:
             updated_at=data["updated_at"],
             model_config=data.get("model_config"),
         )
+        # Загруженный словарь schema 2 сразу служит кэшем сериализации
+        if data.get("schema", 1) >= 2:
+            chat._serialized = data
+        return chat
 
 class ChatManager:
     """Менеджер для управления чатами"""
@@ -62,9 +107,45 @@ class ChatManager:
     def __init__(self, storage_dir: Path):
         self.storage = ChatStorage(storage_dir)
         self.current_chat: Chat = None
+        
+        # Отложенное сохранение: новые сообщения текущего чата,
+        # еще не записанные на диск
+        self._pending: List[Dict[str, Any]] = []
+        self._save_lock = threading.RLock()
+        self._save_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush)
+    
+    def _schedule_flush(self):
+        """Планирует запись накопленных сообщений"""
+        with self._save_lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DEBOUNCE_INTERVAL, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+    
+    def _cancel_flush(self):
+        """Отменяет запланированную запись и сбрасывает накопленные сообщения"""
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            self._pending = []
+    
+    def flush(self):
+        """Записывает накопленные сообщения текущего чата на диск"""
+        with self._save_lock:
+            pending = self._pending
+            self._cancel_flush()
+            if not pending or not self.current_chat:
+                return
+            
+            # Дописываем сообщения в журнал, полный снимок пишется только для нового чата
+            if not self.storage.append_messages(self.current_chat.id, pending):
+                self.storage.save_chat(self.current_chat.to_dict())
     
     def create_chat(self, title: str = "Новый чат", model_config: Dict = None) -> Chat:
         """Создает новый чат"""
+        self.flush()
         chat = Chat(
             id=str(uuid.uuid4()),
             title=title,
@@ -82,27 +163,49 @@ class ChatManager:
         self.current_chat = chat
         return chat
     
+    def _read_chat(self, chat_id: str) -> Optional[Chat]:
+        """Читает и разбирает чат с диска"""
+        self.flush()
+        data = self.storage.load_chat(chat_id)
+        return Chat.from_dict(data) if data else None
+    
     def load_chat(self, chat_id: str) -> bool:
         """Загружает чат по ID"""
-        data = self.storage.load_chat(chat_id)
-        if data:
-            self.current_chat = Chat.from_dict(data)
+        chat = self._read_chat(chat_id)
+        if chat:
+            self.current_chat = chat
+            return True
+        return False
+    
+    async def load_chat_async(self, chat_id: str) -> bool:
+        """Загружает чат по ID, не блокируя цикл событий: чтение и разбор файла идут в потоке"""
+        chat = await asyncio.to_thread(self._read_chat, chat_id)
+        if chat:
+            self.current_chat = chat
             return True
         return False
     
     def save_current_chat(self):
         """Сохраняет текущий чат"""
-        if self.current_chat:
-            self.storage.save_chat(self.current_chat.to_dict())
+        with self._save_lock:
+            # Полный снимок включает и накопленные сообщения
+            self._cancel_flush()
+            if self.current_chat:
+                self.storage.save_chat(self.current_chat.to_dict())
     
     def delete_chat(self, chat_id: str) -> bool:
         """Удаляет чат"""
-        if self.current_chat and self.current_chat.id == chat_id:
-            self.current_chat = None
-        return self.storage.delete_chat(chat_id)
+        with self._save_lock:
+            if self.current_chat and self.current_chat.id == chat_id:
+                self._cancel_flush()
+                self.current_chat = None
+            else:
+                self.flush()
+            return self.storage.delete_chat(chat_id)
     
     def get_chat_list(self) -> List[Dict[str, Any]]:
         """Получает список чатов"""
+        self.flush()
         return self.storage.list_chats()
     
     def add_message(self, role: str, content: str):
@@ -110,8 +213,13 @@ class ChatManager:
         if not self.current_chat:
             raise ValueError("Нет активного чата")
         
-        self.current_chat.add_message(role, content)
-        self.save_current_chat()  # Автосохранение
+        with self._save_lock:
+            message = self.current_chat.add_message(role, content)
+            
+            # Автосохранение откладывается, чтобы серия сообщений
+            # записалась на диск одной операцией
+            self._pending.append(asdict(message))
+        self._schedule_flush()
     
     def get_messages(self) -> List[Message]:
         """Получает сообщения текущего чата"""
@@ -122,5 +230,5 @@ class ChatManager:
     def clear_current_chat(self):
         """Очищает текущий чат (удаляет сообщения)"""
         if self.current_chat:
-            self.current_chat.messages = []
+            self.current_chat.clear_messages()
             self.save_current_chat()
\ No newline at end of file
@@ -1,16 +1,101 @@
 # chat/storage.py
 import json
+import os
 import uuid
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _dumps(data: Any, indent: bool = False) -> bytes:
+    """Сериализация в JSON (orjson, если установлен)"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(data, option=option)
+    return json.dumps(data, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+def _loads(raw: bytes) -> Any:
+    """Десериализация из JSON (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _write_atomic(file_path: Path, data: bytes):
+    """Запись через временный файл и os.replace: при сбое файл не окажется обрезанным"""
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, file_path)
 
 class ChatStorage:
-    """Класс для хранения и загрузки чатов в JSON формате"""
+    """
+    Класс для хранения и загрузки чатов в JSON формате.
+    Чат хранится снимком <id>.json и журналом новых сообщений <id>.jsonl
+    """
     
     def __init__(self, storage_dir: Path):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Кэш метаданных для list_chats: id -> (отметка mtime файлов, метаданные).
+        # Сохраняется в индекс, чтобы после перезапуска не перечитывать все чаты
+        self._meta_cache: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        self._index_path = self.storage_dir / "_index.json"
+        self._index_loaded = False
+    
+    def _load_index(self):
+        """Загружает индекс метаданных; при отсутствии или порче чаты будут перечитаны"""
+        self._index_loaded = True
+        if not self._index_path.exists():
+            return
+        try:
+            index = _loads(self._index_path.read_bytes())
+            for chat_id, entry in index.items():
+                self._meta_cache.setdefault(chat_id, (tuple(entry["mtime"]), entry["meta"]))
+        except Exception as e:
+            print(f"⚠️ Индекс чатов поврежден, будет пересобран: {e}")
+    
+    def _save_index(self):
+        """Атомарно записывает индекс метаданных"""
+        index = {
+            chat_id: {"mtime": list(mtime_key), "meta": meta}
+            for chat_id, (mtime_key, meta) in self._meta_cache.items()
+        }
+        _write_atomic(self._index_path, _dumps(index))
+    
+    def _mtime_key(self, file_path: Path) -> Tuple[int, int]:
+        """Отметка изменения снимка и журнала чата"""
+        log_path = file_path.with_suffix(".jsonl")
+        log_mtime = log_path.stat().st_mtime_ns if log_path.exists() else 0
+        return file_path.stat().st_mtime_ns, log_mtime
+    
+    def _log_path(self, chat_id: str) -> Path:
+        """Путь к журналу сообщений чата"""
+        return self.storage_dir / f"{chat_id}.jsonl"
+    
+    def _read_chat(self, file_path: Path) -> Dict[str, Any]:
+        """
+        Читает снимок чата и применяет к нему журнал сообщений
+        """
+        data = _loads(file_path.read_bytes())
+        
+        log_path = file_path.with_suffix(".jsonl")
+        if log_path.exists():
+            with open(log_path, "rb") as f:
+                logged = [_loads(line) for line in f if line.strip()]
+            if logged:
+                if data.get("schema", 1) >= 2:
+                    data["roles"].extend(m["role"] for m in logged)
+                    data["contents"].extend(m["content"] for m in logged)
+                    data["timestamps"].extend(m.get("timestamp") for m in logged)
+                else:
+                    data.setdefault("messages", []).extend(logged)
+                data["updated_at"] = logged[-1].get("timestamp", data.get("updated_at"))
+        
+        return data
     
     def save_chat(self, chat_data: Dict[str, Any]) -> str:
         """
@@ -24,12 +109,37 @@ class ChatStorage:
         chat_data["updated_at"] = timestamp
         
         file_path = self.storage_dir / f"{chat_id}.json"
+        self._meta_cache.pop(chat_id, None)
+        
+        _write_atomic(file_path, _dumps(chat_data, indent=True))
         
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
+        # Снимок содержит все сообщения, журнал больше не нужен
+        log_path = self._log_path(chat_id)
+        if log_path.exists():
+            log_path.unlink()
         
         return chat_id
     
+    def append_messages(self, chat_id: str, messages: List[Dict[str, Any]]) -> bool:
+        """
+        Дописывает сообщения в журнал чата вместо перезаписи всего файла.
+        Возвращает False, если снимка чата еще нет
+        """
+        if not self.chat_exists(chat_id):
+            return False
+        
+        self._meta_cache.pop(chat_id, None)
+        log_path = self._log_path(chat_id)
+        with open(log_path, "ab") as f:
+            f.write(b"".join(_dumps(message) + b"\n" for message in messages))
+        
+        # Журнал вырос больше снимка - сворачиваем его в новый снимок
+        file_path = self.storage_dir / f"{chat_id}.json"
+        if log_path.stat().st_size > file_path.stat().st_size:
+            self.save_chat(self._read_chat(file_path))
+        
+        return True
+    
     def load_chat(self, chat_id: str) -> Optional[Dict[str, Any]]:
         """
         Загружает чат по ID
@@ -38,39 +148,70 @@ class ChatStorage:
         if not file_path.exists():
             return None
         
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return self._read_chat(file_path)
     
     def delete_chat(self, chat_id: str) -> bool:
         """
         Удаляет чат по ID
         """
         file_path = self.storage_dir / f"{chat_id}.json"
+        self._meta_cache.pop(chat_id, None)
         if file_path.exists():
             file_path.unlink()
+            log_path = self._log_path(chat_id)
+            if log_path.exists():
+                log_path.unlink()
             return True
         return False
     
     def list_chats(self) -> List[Dict[str, Any]]:
         """
-        Возвращает список всех чатов с метаданными
+        Возвращает список всех чатов с метаданными.
+        Перечитываются только файлы, изменившиеся с прошлого вызова
         """
+        if not self._index_loaded:
+            self._load_index()
+        
         chats = []
+        seen = set()
+        index_changed = False
         for json_file in self.storage_dir.glob("*.json"):
+            chat_id = json_file.stem
+            if chat_id.startswith("_"):
+                continue
+            seen.add(chat_id)
             try:
-                with open(json_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    meta = {
-                        "id": data.get("id", json_file.stem),
-                        "title": data.get("title", "Без названия"),
-                        "created_at": data.get("created_at"),
-                        "updated_at": data.get("updated_at"),
-                        "message_count": len(data.get("messages", [])),
-                    }
-                    chats.append(meta)
+                mtime_key = self._mtime_key(json_file)
+                cached = self._meta_cache.get(chat_id)
+                if cached and cached[0] == mtime_key:
+                    chats.append(cached[1])
+                    continue
+                
+                data = self._read_chat(json_file)
+                meta = {
+                    "id": data.get("id", chat_id),
+                    "title": data.get("title", "Без названия"),
+                    "created_at": data.get("created_at"),
+                    "updated_at": data.get("updated_at"),
+                    "message_count": len(data.get("roles", data.get("messages", []))),
+                }
+                self._meta_cache[chat_id] = (mtime_key, meta)
+                index_changed = True
+                chats.append(meta)
             except Exception as e:
                 print(f"⚠️ Ошибка чтения {json_file}: {e}")
         
+        # Удаляем из кэша чаты, файлы которых исчезли
+        for chat_id in self._meta_cache.keys() - seen:
+            del self._meta_cache[chat_id]
+            index_changed = True
+        
+        if index_changed:
+            try:
+                self._save_index()
+            except OSError as e:
+                print(f"⚠️ Не удалось сохранить индекс чатов: {e}")
+        
         # Сортировка по дате обновления (новые первые)
         chats.sort(key=lambda x: x["updated_at"], reverse=True)
         return chats
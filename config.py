@@ -1,7 +1,14 @@
 # config.py
 import os
+import importlib.util
 from pathlib import Path
 
+# Многопоточная загрузка с HuggingFace (Rust), если установлен hf_transfer.
+# Переменная читается один раз при импорте huggingface_hub (его тянет transformers),
+# поэтому задается здесь: config импортируется раньше любых модулей модели
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 # Пути к директориям
 BASE_DIR = Path(__file__).parent.resolve()
 DATA_DIR = BASE_DIR / "data"
@@ -21,6 +28,12 @@ MODEL_CONFIG = {
     "temperature": 0.7,
     "top_p": 0.95,
     "top_k": 40,
+    "compile": True,  # torch.compile для CUDA
+    "quant_backend": "auto",  # auto, awq, gptq, bnb - 4-bit веса на CUDA
+    "kv_cache_bits": 4,  # квантизация KV-кэша на CUDA без compile (HQQ: 1-4/8, quanto: 2/4), None - выключена
+    # Черновая модель для ассистированной (спекулятивной) генерации, None - выключена.
+    # Основная модель тогда не компилируется и KV-кэш не квантуется
+    "draft_model": None,  # например "deepseek-ai/deepseek-coder-1.3b-instruct"
 }
 
 # Настройки UI
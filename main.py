@@ -3,16 +3,17 @@
 import sys
 from pathlib import Path
 import signal
+import threading
+from dataclasses import replace
+from concurrent.futures import Future
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import WordCompleter  # Добавили импорт
-import torch  # Добавили импорт torch
+from prompt_toolkit.patch_stdout import patch_stdout
 
 # Добавляем пути
 sys.path.append(str(Path(__file__).parent))
 
 from config import MODEL_CONFIG, UI_CONFIG, PROMPT_CONFIG, CHATS_DIR
-from model.loader import load_model_simplified, create_dummy_model  # Изменили импорт
-from model.inference import ModelInference
 from chat.manager import ChatManager
 from prompts.hyperprompt import get_hyperprompt
 from ui.app import ChatUI
@@ -27,11 +28,23 @@ def check_model_file():
         return False
     return True
 
+def detect_device() -> str:
+    """Определяет устройство для модели (torch импортируется только здесь)"""
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
 def load_model():
     """Загрузка модели"""
+    # torch и transformers импортируются здесь, а не при старте приложения,
+    # чтобы их тяжелый импорт шел в фоне, пока пользователь уже видит интерфейс
+    from model.loader import load_model_simplified, create_dummy_model
+    
     try:
         from config import MODEL_CONFIG
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = detect_device()
         
         print(f"🚀 Инициализация модели на {device}...")
         
@@ -62,24 +75,57 @@ def setup_hyperprompt():
     """Настройка гиперпромпта"""
     template_name = PROMPT_CONFIG.get("default_template", "default")
     hyperprompt = get_hyperprompt(template_name)
-    hyperprompt.system_template = hyperprompt.system_template.replace(
-        "{{ system_message }}", 
-        PROMPT_CONFIG["system_role"]
+    # Копия с подставленной ролью: общий шаблон из HYPERPROMPT_TEMPLATES не меняется
+    return replace(
+        hyperprompt,
+        system_template=hyperprompt.system_template.replace("{{ system_message }}", PROMPT_CONFIG["system_role"]),
     )
-    return hyperprompt
+
+def start_model_loading(hyperprompt) -> Future:
+    """
+    Запускает загрузку модели в фоновом потоке, чтобы выбор чата и UI
+    были доступны сразу. Future возвращает готовый ModelInference
+    """
+    future = Future()
+    
+    def worker():
+        try:
+            from model.inference import ModelInference
+            
+            model, metadata = load_model()
+            inference = ModelInference(model, metadata)
+            inference.prime_prefix(hyperprompt.format_prefix([]))
+            future.set_result(inference)
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+def install_uvloop():
+    """Включает uvloop для цикла событий UI, если он установлен (кроме Windows)"""
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
 
 def main():
     """Главная функция"""
+    # Политика цикла событий должна быть задана до запуска prompt_toolkit
+    install_uvloop()
+    
     # Проверка модели (не критично для dummy)
     check_model_file()
     
-    # Загрузка модели
-    model, metadata = load_model()
-    inference = ModelInference(model, metadata)
-    
     # Настройка гиперпромпта
     hyperprompt = setup_hyperprompt()
     
+    # Загрузка модели в фоне
+    inference = start_model_loading(hyperprompt)
+    
     # Инициализация менеджера чатов
     chat_manager = ChatManager(CHATS_DIR)
     
@@ -100,23 +146,26 @@ def main():
 ║               LLM TUI - DeepSeek Coder                     ║
 ║                                                             ║
 ║  Модель: {MODEL_CONFIG['model_path'].name[:30]:<30} ║
-║  Устройство: {'CUDA' if torch.cuda.is_available() else 'CPU':>44} ║
+║  Устройство: {'определяется при загрузке модели':>44} ║
 ║  Горячие клавиши: Ctrl+H - Справка                         ║
 ╚════════════════════════════════════════════════════════════╝
 """)
     
-    # Запросить действие при старте
-    action = prompt("Начать [N]овый чат, [L]oad чат или [Q]uit? ", 
-                   completer=WordCompleter(["n", "l", "q"]), default="n").lower()
+    # Запросить действие при старте (модель тем временем грузится,
+    # patch_stdout не дает ее выводу ломать строку ввода)
+    with patch_stdout():
+        action = prompt("Начать [N]овый чат, [L]oad чат или [Q]uit? ", 
+                       completer=WordCompleter(["n", "l", "q"]), default="n").lower()
     
     if action == "l":
         chats = chat_manager.get_chat_list()
         if chats:
             UIComponents.print_header("Доступные чаты")
             for i, chat in enumerate(chats, 1):
-                print(f"{i}. {chat['title']} ({chat['message_count']} сообщений)")
+                print(f"{i}. {UIComponents.format_chat_row(chat)}")
             try:
-                choice = int(prompt("Выберите номер: ")) - 1
+                with patch_stdout():
+                    choice = int(prompt("Выберите номер: ")) - 1
                 if 0 <= choice < len(chats):
                     chat_manager.load_chat(chats[choice]["id"])
             except:
@@ -126,7 +175,8 @@ def main():
     
     # Запуск UI
     try:
-        ui.run()
+        with patch_stdout():
+            ui.run()
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
         import traceback
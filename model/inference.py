@@ -1,8 +1,33 @@
 # model/inference.py
-import torch
-from transformers import AutoTokenizer
-from typing import List, Dict, Generator
+from typing import TYPE_CHECKING, List, Dict, Generator, Optional
+from functools import lru_cache
+from threading import Thread, Event
 import random
+import re
+from .loader import get_tokenizer, get_draft_model
+
+# torch и transformers импортируются только там, где нужны реальной модели:
+# с моделью-заглушкой модуль работает без них
+if TYPE_CHECKING:
+    import torch
+    from transformers import DynamicCache, TextIteratorStreamer
+
+@lru_cache(maxsize=None)
+def _stop_on_event_class():
+    """Класс критерия остановки; создается при первой генерации вместе с импортом transformers"""
+    import torch
+    from transformers import StoppingCriteria
+    
+    class _StopOnEvent(StoppingCriteria):
+        """Останавливает generate, когда потребитель стрима прекратил чтение"""
+        
+        def __init__(self, event: Event):
+            self.event = event
+        
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+    
+    return _StopOnEvent
 
 class ModelInference:
     """Класс для инференса модели"""
@@ -10,7 +35,18 @@ class ModelInference:
     def __init__(self, model, metadata: Dict, device: str = None):
         self.model = model
         self.metadata = metadata
-        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if device is None and not metadata.get("is_dummy"):
+            import torch
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device or "cpu"
+        
+        # Кэш токенов статичного префикса промпта: (текст, input_ids на устройстве)
+        self._prefix_cache = ("", None)
+        # Кэш токенов последнего промпта: следующий ход его продолжает,
+        # поэтому токенизируются только новые сообщения
+        self._prompt_cache = ("", None)
+        # Токены конца генерации для набора стоп-последовательностей
+        self._stop_ids: Dict[tuple, List[int]] = {}
         
         # Загрузка токенизатора
         print("🔤 Загрузка токенизатора...")
@@ -20,14 +56,135 @@ class ModelInference:
             self.tokenizer = DummyTokenizer()
         else:
             try:
+                # Тот же экземпляр, что уже загружен вместе с моделью
                 tokenizer_path = self.metadata.get("tokenizer_path", "deepseek-ai/deepseek-coder-6.7b-instruct")
-                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+                self.tokenizer = get_tokenizer(tokenizer_path)
             except:
                 # Загрузка базового токенизатора Llama
+                from transformers import AutoTokenizer
                 self.tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-7b-hf")
                 self.tokenizer.pad_token = self.tokenizer.eos_token
         
         print(f"✅ Токенизатор загружен!")
+        
+        # Черновая модель для ассистированной генерации (уже загружена загрузчиком)
+        draft_name = metadata.get("draft_model")
+        self.draft_model = get_draft_model(draft_name, self.device) if draft_name else None
+        
+        # KV-кэш прошлой генерации: (токены, которые он покрывает, кэш).
+        # Следующий ход продолжает тот же текст, и prefill считает только новые токены.
+        # Статический/квантованный кэш и ассистированная генерация управляют кэшем сами
+        self._kv_cache = (None, None)
+        generation_config = getattr(model, "generation_config", None)
+        self._reuse_kv = (
+            not metadata.get("is_dummy")
+            and self.draft_model is None
+            and getattr(generation_config, "cache_implementation", None) is None
+        )
+    
+    def prime_prefix(self, prefix: str):
+        """
+        Заранее токенизирует статичный префикс промпта, чтобы первый запрос
+        не тратил на это время. Смена префикса (другой гиперпромпт) заменяет кэш
+        """
+        if self.metadata.get("is_dummy") or not prefix or self._prefix_cache[0] == prefix:
+            return
+        
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt", return_attention_mask=False)["input_ids"]
+        self._prefix_cache = (prefix, prefix_ids.to(self.device))
+    
+    def _eos_token_ids(self, stop_sequences: List[str] = None) -> List[int]:
+        """
+        Токены конца генерации: eos модели и стоп-последовательности, которые
+        являются отдельным токеном словаря. Вычисляется один раз на набор стопов
+        """
+        key = tuple(stop_sequences or ())
+        ids = self._stop_ids.get(key)
+        if ids is None:
+            ids = [self.tokenizer.eos_token_id]
+            unk_id = self.tokenizer.unk_token_id
+            for sequence in key:
+                token_id = self.tokenizer.convert_tokens_to_ids(sequence)
+                if token_id is not None and token_id != unk_id and token_id not in ids:
+                    ids.append(token_id)
+            self._stop_ids[key] = ids
+        return ids
+    
+    def reset_prompt_cache(self):
+        """Сбрасывает кэш токенов и KV-кэш последнего промпта (новый, загруженный или очищенный чат)"""
+        self._prompt_cache = ("", None)
+        self._kv_cache = (None, None)
+    
+    def _take_kv_cache(self, input_ids: "torch.Tensor") -> Optional["DynamicCache"]:
+        """
+        Забирает KV-кэш прошлой генерации, обрезанный до общего с input_ids префикса.
+        Последний токен промпта всегда остается на prefill, чтобы получить логиты
+        """
+        cached_ids, cache = self._kv_cache
+        self._kv_cache = (None, None)
+        if cache is None:
+            return None
+        
+        length = min(cached_ids.shape[1], input_ids.shape[1] - 1)
+        mismatch = (cached_ids[0, :length] != input_ids[0, :length]).nonzero()
+        common = mismatch[0].item() if len(mismatch) else length
+        if common <= 0:
+            return None
+        
+        cache.crop(common)
+        return cache
+    
+    def _run_generate(self, gen_kwargs: Dict) -> "torch.Tensor":
+        """
+        Вызывает model.generate и сохраняет получившийся KV-кэш для следующего хода
+        """
+        import torch
+        
+        with torch.inference_mode():
+            outputs = self.model.generate(**gen_kwargs)
+        
+        cache = gen_kwargs.get("past_key_values")
+        if cache is not None:
+            self._kv_cache = (outputs[:, :cache.get_seq_length()], cache)
+        return outputs
+    
+    def _encode(self, prompt: str, prefix: str = "") -> "torch.Tensor":
+        """
+        Токенизирует промпт сразу на устройство модели. Если он продолжает
+        предыдущий промпт или начинается со статичного префикса, их токены
+        берутся из кэша на устройстве, а токенизируется только остаток
+        """
+        import torch
+        
+        cached_text, cached_ids = self._prompt_cache
+        if not (cached_text and prompt.startswith(cached_text)):
+            if prefix and prompt.startswith(prefix):
+                self.prime_prefix(prefix)
+                cached_text, cached_ids = self._prefix_cache
+            else:
+                cached_text, cached_ids = "", None
+        
+        if cached_ids is None:
+            input_ids = self.tokenizer(prompt, return_tensors="pt", return_attention_mask=False)["input_ids"].to(self.device)
+        else:
+            delta_ids = self.tokenizer(
+                prompt[len(cached_text):], add_special_tokens=False, return_tensors="pt", return_attention_mask=False
+            )["input_ids"]
+            input_ids = torch.cat([cached_ids, delta_ids.to(self.device)], dim=-1)
+        
+        self._prompt_cache = (prompt, input_ids)
+        return input_ids
+    
+    def _generate_worker(self, gen_kwargs: Dict, streamer: "TextIteratorStreamer", errors: List[Exception]):
+        """
+        Фоновый поток генерации. Ошибка сохраняется для потребителя стрима,
+        а стример закрывается, чтобы потребитель не ждал вечно
+        """
+        try:
+            self._run_generate(gen_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
     
     def generate(
         self,
@@ -37,10 +194,12 @@ class ModelInference:
         top_p: float = 0.95,
         top_k: int = 40,
         stop_sequences: List[str] = None,
-        stream: bool = True
+        stream: bool = True,
+        prefix: str = ""
     ) -> Generator[str, None, None]:
         """
-        Генерация текста с параметрами семплинга
+        Генерация текста с параметрами семплинга.
+        prefix - статичное начало prompt, токены которого кэшируются между вызовами
         """
         if self.metadata.get("is_dummy"):
             # Тестовая генерация для dummy модели
@@ -53,49 +212,67 @@ class ModelInference:
             
             response = random.choice(responses)
             if stream:
-                for char in response:
-                    yield char
+                # Отдаем по словам, а не по символам: меньше пробуждений UI
+                for word in re.findall(r"\S+\s*", response):
+                    yield word
             else:
                 yield response
             return
         
-        # Здесь будет реальная генерация для настоящей модели
-        # Пока используем упрощенную реализацию
         try:
-            inputs = self.tokenizer(prompt, return_tensors="pt", return_attention_mask=False)
-            input_ids = inputs["input_ids"].to(self.device)
+            from transformers import DynamicCache, TextIteratorStreamer, StoppingCriteriaList
             
-            # Генерация через модель
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    input_ids,
-                    max_new_tokens=min(max_tokens, 512),
-                    temperature=temperature,
-                    top_p=top_p,
-                    top_k=top_k,
-                    do_sample=temperature > 0,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
+            input_ids = self._encode(prompt, prefix)
             
-            # Декодируем только новые токены
-            new_tokens = outputs[0][input_ids.shape[1]:]
-            response = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+            gen_kwargs = dict(
+                input_ids=input_ids,
+                max_new_tokens=min(max_tokens, 512),
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                do_sample=temperature > 0,
+                use_cache=True,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self._eos_token_ids(stop_sequences),
+            )
+            if self._reuse_kv:
+                gen_kwargs["past_key_values"] = self._take_kv_cache(input_ids) or DynamicCache()
+            if self.draft_model is not None:
+                # Черновая модель предлагает несколько токенов, основная проверяет их за один проход
+                gen_kwargs["assistant_model"] = self.draft_model
+                gen_kwargs["num_assistant_tokens"] = 5
             
-            if stream:
-                for char in response:
-                    yield char
-            else:
-                yield response
+            if not stream:
+                outputs = self._run_generate(gen_kwargs)
+                # Декодируем только новые токены
+                new_tokens = outputs[0][input_ids.shape[1]:]
+                yield self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+                return
+            
+            # model.generate работает в фоновом потоке и отдает текст через стример
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            stop_event = Event()
+            errors = []
+            gen_kwargs["streamer"] = streamer
+            gen_kwargs["stopping_criteria"] = StoppingCriteriaList([_stop_on_event_class()(stop_event)])
+            thread = Thread(target=self._generate_worker, args=(gen_kwargs, streamer, errors), daemon=True)
+            thread.start()
+            
+            try:
+                for text in streamer:
+                    if text:
+                        yield text
+            finally:
+                # Генератор закрыт раньше времени (прерывание) - останавливаем и модель
+                stop_event.set()
+                thread.join()
+            
+            if errors:
+                raise errors[0]
                 
         except Exception as e:
             # Запасной вариант - простой ответ
-            response = f"Извините, произошла ошибка при генерации: {str(e)}"
-            if stream:
-                for char in response:
-                    yield char
-            else:
-                yield response
+            yield f"Извините, произошла ошибка при генерации: {str(e)}"
 
 class DummyTokenizer:
     """Токенизатор-заглушка для тестирования"""
@@ -115,5 +292,6 @@ class DummyTokenizer:
         return " ".join([f"token_{tid}" for tid in token_ids if tid < 100])
     
     def __call__(self, text: str, return_tensors=None, return_attention_mask=False):
+        import torch
         tokens = self.encode(text)
         return {"input_ids": torch.tensor([tokens])}
\ No newline at end of file
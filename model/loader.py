@@ -1,113 +1,339 @@
 # model/loader.py
-import torch
+import importlib.util
 from pathlib import Path
-from typing import Dict, Any
+from typing import TYPE_CHECKING, Dict, Any, Optional
 import json
+from functools import lru_cache
+from config import MODEL_CONFIG
 
-def load_model_simplified(model_path: Path, device: str = "cuda" if torch.cuda.is_available() else "cpu"):
+# torch импортируется только внутри функций загрузки: импорт модуля
+# (например, для заглушки) не инициализирует torch и CUDA
+if TYPE_CHECKING:
+    import torch
+
+# Файлы репозитория, нужные для загрузки: без дублирующих .bin/.msgpack/.h5 весов
+DOWNLOAD_PATTERNS = ["*.safetensors", "*.json", "*.py", "*.model", "*.txt", "tokenizer*"]
+
+# Заранее квантованные (W4A16) чекпоинты модели: их ядра делают деквантизацию
+# внутри matmul и при генерации по одному запросу быстрее bitsandbytes NF4
+QUANTIZED_MODELS = {
+    "awq": "TheBloke/deepseek-coder-6.7B-instruct-AWQ",
+    "gptq": "TheBloke/deepseek-coder-6.7B-instruct-GPTQ",
+}
+
+# Пакеты, без которых соответствующий бэкенд недоступен
+QUANT_BACKEND_PACKAGES = {
+    "awq": ("awq",),
+    "gptq": ("auto_gptq", "optimum"),
+}
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name: str):
     """
-    Упрощенная загрузка модели через transformers
-    Вместо GGUF используем прямую загрузку из HuggingFace
+    Загружает токенизатор один раз на процесс:
+    загрузчик модели и инференс используют один и тот же экземпляр
     """
-    print(f"🚀 Загрузка модели через transformers...")
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+
+def _compute_dtype(device: str) -> "torch.dtype":
+    """
+    Тип вычислений: bf16 на CPU и Ampere+ (без переполнений fp16), иначе fp16
+    """
+    import torch
     
+    if device == "cpu":
+        return torch.bfloat16
+    # Проверка compute capability, а не is_bf16_supported(): с torch 2.4 та учитывает
+    # эмуляцию и возвращает True на T4/V100, где bf16 медленный
+    if device == "cuda" and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+def _download_model(model_name: str):
+    """
+    Скачивает в кэш HuggingFace только нужные файлы модели, в несколько потоков.
+    При ошибке (например, нет сети) загрузка продолжится через from_pretrained
+    """
     try:
-        # Попробуем загрузить как обычную модель transformers
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        
-        # Для начала используем модель из HuggingFace
-        model_name = "deepseek-ai/deepseek-coder-6.7b-instruct"
-        
-        print(f"📦 Загрузка {model_name}...")
-        
-        # Загружаем токенизатор
-        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        
-        # Загружаем модель в 4-bit квантизации для экономии памяти
-        model = AutoModelForCausalLM.from_pretrained(
+        from huggingface_hub import snapshot_download
+        snapshot_download(model_name, allow_patterns=DOWNLOAD_PATTERNS, max_workers=16, etag_timeout=30)
+    except Exception as e:
+        print(f"⚠️  Предзагрузка файлов модели не удалась: {e}")
+
+def _from_pretrained(model_name: str, **kwargs):
+    """
+    Загружает веса из safetensors (mmap без лишней копии в памяти),
+    при отсутствии safetensors - из .bin
+    """
+    from transformers import AutoModelForCausalLM
+    
+    kwargs.setdefault("low_cpu_mem_usage", True)
+    kwargs.setdefault("use_safetensors", True)
+    try:
+        return AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+    except OSError:
+        if not kwargs["use_safetensors"]:
+            raise
+        # Повтор через эту же функцию, чтобы для .bin тоже работал откат FlashAttention-2 -> SDPA
+        print("⚠️  safetensors веса не найдены, загрузка .bin")
+        kwargs["use_safetensors"] = False
+        return _from_pretrained(model_name, **kwargs)
+    except (ImportError, ValueError) as e:
+        # FlashAttention-2 не поддерживается моделью или GPU - используем SDPA
+        if kwargs.get("attn_implementation") != "flash_attention_2":
+            raise
+        print(f"⚠️  FlashAttention-2 недоступен, используется SDPA: {e}")
+        kwargs["attn_implementation"] = "sdpa"
+        return _from_pretrained(model_name, **kwargs)
+
+def _device_map(device: str):
+    """
+    Размещение весов на CUDA: вся модель на одном устройстве, если GPU один (без планировщика
+    accelerate и без переходов CPU<->GPU внутри forward); "auto" - только для нескольких GPU
+    """
+    import torch
+    
+    if torch.cuda.device_count() > 1:
+        return "auto"
+    return {"": 0}
+
+def _attn_implementation(device: str) -> str:
+    """
+    Реализация attention: FlashAttention-2 на CUDA при установленном flash_attn,
+    иначе SDPA (fused kernel PyTorch) вместо eager
+    """
+    if device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+def _compile_model(model, tokenizer, device: str):
+    """
+    Компилирует модель через torch.compile и прогревает ее,
+    чтобы стоимость компиляции не попадала на первый запрос
+    """
+    import torch
+    
+    if device != "cuda" or not MODEL_CONFIG.get("compile", False) or not hasattr(torch, "compile"):
+        return model
+    
+    torch.backends.cuda.matmul.allow_tf32 = True
+    
+    # Компилируем forward, а не весь модуль: generate вызывает именно его.
+    # Статический KV-кэш фиксирует формы тензоров, что позволяет CUDA graphs
+    # в режиме reduce-overhead на шаге декодирования
+    eager_forward = model.forward
+    try:
+        print("⚙️  Компиляция модели (torch.compile)...")
+        model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", dynamic=True)
+        warmup_ids = tokenizer("Hello", return_tensors="pt")["input_ids"].to(model.device)
+        with torch.no_grad():
+            model.generate(warmup_ids, max_new_tokens=4, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+    except Exception as e:
+        print(f"⚠️  torch.compile недоступен, используется eager режим: {e}")
+        model.forward = eager_forward
+        model.generation_config.cache_implementation = None
+    
+    return model
+
+def _resolve_quant_backend(device: str) -> str:
+    """
+    Выбирает бэкенд квантизации: из MODEL_CONFIG["quant_backend"] или,
+    для "auto", первый установленный из AWQ -> GPTQ -> bitsandbytes.
+    На CPU квантизация не используется ("none")
+    """
+    if device != "cuda":
+        return "none"
+    
+    backend = MODEL_CONFIG.get("quant_backend", "auto")
+    if backend != "auto":
+        return backend
+    
+    for name in ("awq", "gptq"):
+        if all(importlib.util.find_spec(pkg) is not None for pkg in QUANT_BACKEND_PACKAGES[name]):
+            return name
+    return "bnb"
+
+# Бэкенды квантизованного KV-кэша transformers: пакет, который проверяет transformers,
+# допустимая разрядность и оси квантизации (рекомендованные документацией HF)
+KV_CACHE_BACKENDS = (
+    ("HQQ", "hqq", (1, 2, 3, 4, 8), {"axis_key": 1, "axis_value": 1}),
+    ("quanto", "quanto", (2, 4), {"axis_key": 0, "axis_value": 0}),
+)
+
+def _configure_kv_cache(model, tokenizer, device: str):
+    """
+    Включает квантизованный KV-кэш (HQQ или quanto) и проверяет его короткой генерацией.
+    Несовместим со статическим кэшем compile-режима.
+    Возвращает разрядность кэша или None, если квантизация не включена
+    """
+    import torch
+    
+    bits = MODEL_CONFIG.get("kv_cache_bits")
+    if not bits or device != "cuda" or model.generation_config.cache_implementation is not None:
+        return None
+    
+    for backend, package, supported_bits, axes in KV_CACHE_BACKENDS:
+        if bits in supported_bits and importlib.util.find_spec(package) is not None:
+            break
+    else:
+        return None
+    
+    model.generation_config.cache_implementation = "quantized"
+    model.generation_config.cache_config = {"backend": backend, "nbits": bits, **axes}
+    try:
+        warmup_ids = tokenizer("Hello", return_tensors="pt")["input_ids"].to(model.device)
+        with torch.no_grad():
+            model.generate(warmup_ids, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+    except Exception as e:
+        print(f"⚠️  Квантизованный KV-кэш ({backend}) недоступен, используется обычный: {e}")
+        model.generation_config.cache_implementation = None
+        model.generation_config.cache_config = None
+        return None
+    
+    return bits
+
+def _quantization_config(compute_dtype: "torch.dtype"):
+    """
+    4-bit квантизация весов: NF4 + двойная квантизация констант (рецепт QLoRA)
+    """
+    from transformers import BitsAndBytesConfig
+    
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_compute_dtype=compute_dtype,
+    )
+
+def _build_metadata(model, tokenizer, model_name: str, compute_dtype: "torch.dtype") -> Dict[str, Any]:
+    """Метаданные загруженной модели"""
+    return {
+        "vocab_size": tokenizer.vocab_size,
+        "hidden_size": model.config.hidden_size,
+        "intermediate_size": model.config.intermediate_size,
+        "num_layers": model.config.num_hidden_layers,
+        "num_heads": model.config.num_attention_heads,
+        "num_kv_heads": getattr(model.config, 'num_key_value_heads', model.config.num_attention_heads),
+        "max_seq_len": getattr(model.config, 'max_position_embeddings', 4096),
+        "norm_eps": getattr(model.config, 'rms_norm_eps', 1e-6),
+        "model_type": model.config.model_type,
+        "tokenizer_path": model_name,
+        "pad_token_id": tokenizer.pad_token_id,
+        "bos_token_id": tokenizer.bos_token_id,
+        "eos_token_id": tokenizer.eos_token_id,
+        "max_tokens": 2048,
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "top_k": 40,
+        "compute_dtype": str(compute_dtype),
+    }
+
+@lru_cache(maxsize=None)
+def get_draft_model(model_name: str, device: str):
+    """
+    Загружает черновую модель для ассистированной генерации один раз на процесс.
+    Она должна использовать тот же токенизатор, что и основная модель.
+    Возвращает None, если загрузить ее не удалось
+    """
+    try:
+        print(f"📦 Загрузка черновой модели {model_name}...")
+        _download_model(model_name)
+        compute_dtype = _compute_dtype(device)
+        if device == "cuda":
+            quant_kwargs = {"quantization_config": _quantization_config(compute_dtype), "device_map": _device_map(device)}
+        else:
+            quant_kwargs = {"torch_dtype": compute_dtype}
+        draft = _from_pretrained(
             model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            load_in_4bit=True,
-            trust_remote_code=True
+            trust_remote_code=True,
+            attn_implementation=_attn_implementation(device),
+            **quant_kwargs
         )
-        
-        # Метаданные
-        metadata = {
-            "vocab_size": tokenizer.vocab_size,
-            "hidden_size": model.config.hidden_size,
-            "intermediate_size": model.config.intermediate_size,
-            "num_layers": model.config.num_hidden_layers,
-            "num_heads": model.config.num_attention_heads,
-            "num_kv_heads": getattr(model.config, 'num_key_value_heads', model.config.num_attention_heads),
-            "max_seq_len": getattr(model.config, 'max_position_embeddings', 4096),
-            "norm_eps": getattr(model.config, 'rms_norm_eps', 1e-6),
-            "model_type": model.config.model_type,
-            "pad_token_id": tokenizer.pad_token_id,
-            "bos_token_id": tokenizer.bos_token_id,
-            "eos_token_id": tokenizer.eos_token_id,
-            "max_tokens": 2048,
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-        }
-        
-        print(f"✅ Модель загружена успешно!")
-        print(f"   Архитектура: {metadata['model_type']}")
-        print(f"   Параметры: {metadata['hidden_size']}")
-        print(f"   Слои: {metadata['num_layers']}")
-        
-        return model, metadata
-        
+        return draft.eval()
+    except Exception as e:
+        print(f"⚠️  Черновая модель не загружена, обычная генерация: {e}")
+        return None
+
+@lru_cache(maxsize=2)
+def _load_cached(model_name: str, device: str, backend: str):
+    """
+    Загружает модель один раз на ключ (модель, устройство, бэкенд):
+    повторный вызов не перечитывает и не переквантует веса
+    """
+    # На CUDA веса 4-bit: готовый AWQ/GPTQ чекпоинт (его ядра работают в fp16)
+    # или квантизация NF4 через bitsandbytes при загрузке.
+    # На CPU квантизация недоступна: грузим bf16 веса
+    import torch
+    
+    weights_name = QUANTIZED_MODELS.get(backend, model_name)
+    if backend in QUANTIZED_MODELS:
+        compute_dtype = torch.float16
+        quant_kwargs = {"torch_dtype": compute_dtype, "device_map": _device_map(device)}
+    elif backend == "bnb":
+        compute_dtype = _compute_dtype(device)
+        quant_kwargs = {"quantization_config": _quantization_config(compute_dtype), "device_map": _device_map(device)}
+    else:
+        compute_dtype = _compute_dtype(device)
+        quant_kwargs = {"torch_dtype": compute_dtype}
+    
+    print(f"📦 Загрузка {weights_name} (квантизация: {backend})...")
+    _download_model(weights_name)
+    
+    # Загружаем токенизатор (из исходного репозитория: он общий для всех чекпоинтов)
+    tokenizer = get_tokenizer(model_name)
+    
+    model = _from_pretrained(
+        weights_name,
+        trust_remote_code=True,
+        attn_implementation=_attn_implementation(device),
+        **quant_kwargs
+    )
+    model.eval()
+    
+    # Ассистированная генерация не работает со статическим и квантованным кэшем
+    draft_name = MODEL_CONFIG.get("draft_model")
+    if draft_name and get_draft_model(draft_name, device) is None:
+        draft_name = None
+    if not draft_name:
+        model = _compile_model(model, tokenizer, device)
+    
+    metadata = _build_metadata(model, tokenizer, model_name, compute_dtype)
+    metadata["quant_backend"] = backend
+    metadata["attn_implementation"] = getattr(model.config, "_attn_implementation", None)
+    metadata["kv_cache_bits"] = None if draft_name else _configure_kv_cache(model, tokenizer, device)
+    metadata["draft_model"] = draft_name
+    return model, metadata
+
+def load_model_simplified(model_path: Path, device: Optional[str] = None):
+    """
+    Упрощенная загрузка модели через transformers
+    Вместо GGUF используем прямую загрузку из HuggingFace.
+    Без device устройство выбирается автоматически: CUDA, если доступна
+    """
+    if device is None:
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    
+    print(f"🚀 Загрузка модели через transformers...")
+    
+    # Для начала используем модель из HuggingFace
+    model_name = "deepseek-ai/deepseek-coder-6.7b-instruct"
+    
+    try:
+        model, metadata = _load_cached(model_name, device, _resolve_quant_backend(device))
     except Exception as e:
         print(f"❌ Ошибка загрузки через transformers: {e}")
-        print("Попробуйте альтернативный метод...")
-        
-        # Альтернативный метод - используем библиотеку bitsandbytes
-        try:
-            from transformers import BitsAndBytesConfig
-            
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4"
-            )
-            
-            model_name = "deepseek-ai/deepseek-coder-6.7b-instruct"
-            tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-            
-            model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                quantization_config=quantization_config,
-                device_map="auto",
-                trust_remote_code=True
-            )
-            
-            metadata = {
-                "vocab_size": tokenizer.vocab_size,
-                "hidden_size": model.config.hidden_size,
-                "intermediate_size": model.config.intermediate_size,
-                "num_layers": model.config.num_hidden_layers,
-                "num_heads": model.config.num_attention_heads,
-                "num_kv_heads": getattr(model.config, 'num_key_value_heads', model.config.num_attention_heads),
-                "max_seq_len": getattr(model.config, 'max_position_embeddings', 4096),
-                "norm_eps": getattr(model.config, 'rms_norm_eps', 1e-6),
-                "model_type": model.config.model_type,
-                "pad_token_id": tokenizer.pad_token_id,
-                "bos_token_id": tokenizer.bos_token_id,
-                "eos_token_id": tokenizer.eos_token_id,
-                "max_tokens": 2048,
-                "temperature": 0.7,
-                "top_p": 0.95,
-                "top_k": 40,
-            }
-            
-            return model, metadata
-            
-        except Exception as e2:
-            print(f"❌ Альтернативный метод тоже не работает: {e2}")
-            raise e2
+        raise
+    
+    print(f"✅ Модель загружена успешно!")
+    print(f"   Архитектура: {metadata['model_type']}")
+    print(f"   Параметры: {metadata['hidden_size']}")
+    print(f"   Слои: {metadata['num_layers']}")
+    
+    # Копия метаданных: кэшированный словарь не должен меняться вызывающим кодом
+    return model, dict(metadata)
 
 def create_dummy_model(device: str = "cpu"):
     """
@@ -131,12 +357,17 @@ def create_dummy_model(device: str = "cpu"):
                 'bos_token_id': 1,
                 'eos_token_id': 2,
             })()
+            # Буфер ответа создается при первом вызове generate (torch импортируется лениво)
+            self._out = None
         
         def generate(self, *args, **kwargs):
-            # Возвращаем dummy тензор
-            import torch
-            batch_size = kwargs.get('input_ids', torch.randn(1, 10)).shape[0]
-            return torch.randn(batch_size, 50)  # dummy output
+            # Возвращаем dummy тензор: view одного буфера нулей, без выделения памяти
+            if self._out is None:
+                import torch
+                self._out = torch.zeros(1, 50)
+            input_ids = kwargs.get('input_ids')
+            batch_size = input_ids.shape[0] if input_ids is not None else 1
+            return self._out.expand(batch_size, 50)  # dummy output
         
         def to(self, device):
             return self
@@ -169,4 +400,4 @@ def create_dummy_model(device: str = "cpu"):
     return model, metadata
 
 
-__all__ = ['load_model_simplified', 'create_dummy_model']
\ No newline at end of file
+__all__ = ['load_model_simplified', 'create_dummy_model', 'get_tokenizer', 'get_draft_model']
\ No newline at end of file
@@ -1,46 +1,105 @@
 # prompts/hyperprompt.py
-from dataclasses import dataclass
-from typing import Dict, List
-from jinja2 import Template
+import re
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, List, Optional, Pattern, Tuple
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class HyperPrompt:
-    """Класс для управления гиперпромптами"""
+    """
+    Класс для управления гиперпромптами.
+    Неизменяемый: измененная копия создается через dataclasses.replace
+    """
     system_template: str
     user_template: str = "{{ message }}"
     assistant_template: str = "{{ message }}"
-    stop_sequences: List[str] = None
+    stop_sequences: Tuple[str, ...] = field(default_factory=tuple)
+    
+    # Шаблоны, заранее разрезанные по месту подстановки:
+    # "голова{{ message }}хвост" -> ("голова", "хвост"), подстановка - content.join(части)
+    _system_parts: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _user_parts: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _assistant_parts: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    # Поиск стоп-последовательностей в тексте ответа: одно регулярное выражение
+    # на все последовательности и множество их собственных префиксов
+    _stop_pattern: Optional[Pattern] = field(init=False, repr=False, compare=False)
+    _stop_prefixes: FrozenSet[str] = field(init=False, repr=False, compare=False)
+    _stop_max_prefix: int = field(init=False, repr=False, compare=False)
     
     def __post_init__(self):
-        if self.stop_sequences is None:
-            self.stop_sequences = []
+        # frozen dataclass: производные поля задаются в обход запрета присваивания
+        object.__setattr__(self, "stop_sequences", tuple(self.stop_sequences or ()))
+        object.__setattr__(self, "_system_parts", tuple(self.system_template.split("{{ system_message }}")))
+        object.__setattr__(self, "_user_parts", tuple(self.user_template.split("{{ message }}")))
+        object.__setattr__(self, "_assistant_parts", tuple(self.assistant_template.split("{{ message }}")))
+        
+        stops = sorted(filter(None, self.stop_sequences), key=len, reverse=True)
+        object.__setattr__(self, "_stop_pattern", re.compile("|".join(map(re.escape, stops))) if stops else None)
+        object.__setattr__(self, "_stop_prefixes", frozenset(stop[:i] for stop in stops for i in range(1, len(stop))))
+        object.__setattr__(self, "_stop_max_prefix", len(stops[0]) - 1 if stops else 0)
     
-    def format_prompt(self, messages: List[Dict[str, str]]) -> str:
+    def find_stop(self, text: str) -> Optional[int]:
+        """Позиция первой стоп-последовательности в тексте или None"""
+        if self._stop_pattern is None:
+            return None
+        match = self._stop_pattern.search(text)
+        return match.start() if match else None
+    
+    def stop_holdback(self, text: str) -> int:
         """
-        Форматирует полный промпт из истории сообщений
+        Длина конца текста, который может оказаться началом стоп-последовательности:
+        его нельзя показывать, пока не придет продолжение
+        """
+        for length in range(min(len(text), self._stop_max_prefix), 0, -1):
+            if text[-length:] in self._stop_prefixes:
+                return length
+        return 0
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Настройки гиперпромпта для сохранения в чате"""
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+    
+    def format_prefix(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Форматирует статичную часть промпта (системный блок).
+        Она не меняется между ходами, поэтому ее токены можно кэшировать
+        """
+        sys_msg = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        return sys_msg.join(self._system_parts)
+    
+    def format_turns(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Форматирует историю сообщений без системного блока.
+        Части собираются в список и склеиваются один раз
         """
-        formatted = ""
-        
-        # System prompt
         if messages and messages[0]["role"] == "system":
-            sys_msg = messages[0]["content"]
-            formatted += self.system_template.replace("{{ system_message }}", sys_msg)
             messages = messages[1:]
         
-        # Добавление истории сообщений
+        parts = []
         for msg in messages:
             role = msg["role"]
-            content = msg["content"]
             
             if role == "user":
-                formatted += self.user_template.replace("{{ message }}", content)
+                parts.append(msg["content"].join(self._user_parts))
             elif role == "assistant":
-                formatted += self.assistant_template.replace("{{ message }}", content)
+                parts.append(msg["content"].join(self._assistant_parts))
         
-        return formatted
+        return "".join(parts)
+    
+    def format_prompt(self, messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
+        """
+        Форматирует полный промпт из истории сообщений.
+        С add_generation_prompt в конец добавляется начало ответа ассистента
+        (часть assistant_template до {{ message }}), чтобы модель отвечала от его имени
+        """
+        prompt = self.format_prefix(messages) + self.format_turns(messages)
+        if add_generation_prompt:
+            prompt += self._assistant_parts[0]
+        return prompt
 
-# Предустановленные шаблоны
-HYPERPROMPT_TEMPLATES = {
+# Предустановленные шаблоны (только для чтения: экземпляры HyperPrompt общие)
+HYPERPROMPT_TEMPLATES = MappingProxyType({
     "default": HyperPrompt(
         system_template="""<|im_start|>system
 {{ system_message }}<|im_end|>
@@ -51,7 +110,7 @@ HYPERPROMPT_TEMPLATES = {
         assistant_template="""<|im_start|>assistant
 {{ message }}<|im_end|>
 """,
-        stop_sequences=["<|im_end|>", "<|endoftext|>"]
+        stop_sequences=("<|im_end|>", "<|endoftext|>")
     ),
     
     "deepseek": HyperPrompt(
@@ -65,7 +124,7 @@ HYPERPROMPT_TEMPLATES = {
         assistant_template="""{{ message }}
 
 """,
-        stop_sequences=["###", "<|endoftext|>"]
+        stop_sequences=("###", "<|endoftext|>")
     ),
     
     "simple": HyperPrompt(
@@ -78,10 +137,11 @@ HYPERPROMPT_TEMPLATES = {
         assistant_template="""Assistant: {{ message }}
 
 """,
-        stop_sequences=["System:", "User:", "Assistant:"]
+        stop_sequences=("System:", "User:", "Assistant:")
     )
-}
+})
 
+@lru_cache(maxsize=None)
 def get_hyperprompt(template_name: str = "default") -> HyperPrompt:
     """Получает гиперпромпт по имени шаблона"""
     return HYPERPROMPT_TEMPLATES.get(template_name, HYPERPROMPT_TEMPLATES["default"])
\ No newline at end of file
@@ -6,23 +6,88 @@ from prompt_toolkit.layout.layout import Layout
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.styles import Style
 from prompt_toolkit.widgets import TextArea, Frame, Label
-from prompt_toolkit.application import get_app
+from prompt_toolkit.application import get_app, run_in_terminal
 from prompt_toolkit.buffer import Buffer
 from prompt_toolkit.document import Document
 import asyncio
 import threading
-from typing import Optional, Callable
+import time
+from datetime import datetime
+from concurrent.futures import Future
+from typing import List, Optional, Callable
+from config import MODEL_CONFIG
+from .components import UIComponents, ROLE_PREFIXES
+
+# Пакетная отправка токенов в UI: размер пакета растет от 1 до STREAM_MAX_BATCH,
+# чтобы первый токен показывался сразу, а дальше UI не перерисовывался на каждый токен
+STREAM_MAX_BATCH = 32
+STREAM_FLUSH_INTERVAL = 0.025  # секунды
+
+# Перерисовка экрана не чаще 30 раз в секунду: изменения истории и статуса
+# между кадрами попадают в одну перерисовку
+REDRAW_INTERVAL = 1 / 30
+
+# Тексты справки и конфигурации не меняются во время работы
+_HELP_TEXT = """
+Доступные команды:
+  /new     - Создать новый чат
+  /load    - Загрузить существующий чат
+  /save    - Сохранить текущий чат
+  /delete  - Удалить чат
+  /clear   - Очистить историю текущего чата
+  /config  - Показать конфигурацию
+  /exit    - Выйти из приложения
+  /help    - Показать эту справку
+
+Горячие клавиши:
+  Ctrl+N   - Новый чат
+  Ctrl+L   - Загрузить чат
+  Ctrl+S   - Сохранить чат
+  Ctrl+H   - Помощь
+  Ctrl+C   - Прервать генерацию
+  Ctrl+Q   - Выход
+"""
+
+_CONFIG_TEXT = f"""
+Модель: {MODEL_CONFIG['model_path']}
+Max tokens: {MODEL_CONFIG['max_tokens']}
+Temperature: {MODEL_CONFIG['temperature']}
+Top-p: {MODEL_CONFIG['top_p']}
+Top-k: {MODEL_CONFIG['top_k']}
+"""
+
+# Стиль интерфейса создается один раз на процесс
+_STYLE = Style([
+    ("chat-frame", "bg:#282c34 #abb2bf"),
+    ("input-frame", "bg:#282c34 #abb2bf"),
+    ("text-area", "bg:#1e2127 #abb2bf"),
+    ("input-field", "bg:#1e2127 #abb2bf"),
+    ("status", "bg:#3e4451 #abb2bf"),
+])
+
+# Заготовленные заголовки сообщений в истории: "\n<роль>\n"
+_ENTRY_HEADERS = {role: f"\n{prefix}\n" for role, prefix in ROLE_PREFIXES.items()}
 
 class ChatUI:
     """Основной класс TUI интерфейса"""
     
     def __init__(self, chat_manager, model_inference, hyperprompt):
         self.chat_manager = chat_manager
-        self.model_inference = model_inference
         self.hyperprompt = hyperprompt
         
+        # model_inference может быть Future: модель еще загружается в фоне
+        if isinstance(model_inference, Future):
+            self._inference_future = model_inference
+            self.model_inference = None
+        else:
+            self._inference_future = None
+            self.model_inference = model_inference
+        
         self.generating = False
         self.current_response = ""
+        self._response_chunks: List[str] = []
+        # Позиция в тексте истории, с которой начинается текущий ответ
+        self._response_start = 0
         
         # История сообщений
         self.chat_history = TextArea(
@@ -32,6 +97,8 @@ class ChatUI:
             height=None,
             style="class:text-area"
         )
+        # Курсор в конце: история прокручивается за новыми сообщениями
+        self.chat_history.buffer.cursor_position = len(self.chat_history.text)
         
         # Поле ввода
         self.input_field = TextArea(
@@ -62,6 +129,7 @@ class ChatUI:
             style=self._get_style(),
             full_screen=True,
             mouse_support=True,
+            min_redraw_interval=REDRAW_INTERVAL,
         )
         
         # Callback для генерации
@@ -90,13 +158,7 @@ class ChatUI:
     
     def _get_style(self):
         """Стилизация интерфейса"""
-        return Style([
-            ("chat-frame", "bg:#282c34 #abb2bf"),
-            ("input-frame", "bg:#282c34 #abb2bf"),
-            ("text-area", "bg:#1e2127 #abb2bf"),
-            ("input-field", "bg:#1e2127 #abb2bf"),
-            ("status", "bg:#3e4451 #abb2bf"),
-        ])
+        return _STYLE
     
     def _setup_keybindings(self):
         """Настройка горячих клавиш"""
@@ -149,17 +211,17 @@ class ChatUI:
         cmd = command.lower().strip()
         
         if cmd == "/exit":
-            self._exit_app()
+            asyncio.create_task(self._exit_app())
         elif cmd == "/new":
-            self._new_chat()
+            asyncio.create_task(self._new_chat())
         elif cmd == "/load":
-            self._load_chat()
+            asyncio.create_task(self._load_chat())
         elif cmd == "/save":
             self._save_chat()
         elif cmd == "/delete":
-            self._delete_chat()
+            asyncio.create_task(self._delete_chat())
         elif cmd == "/clear":
-            self._clear_chat()
+            asyncio.create_task(self._clear_chat())
         elif cmd == "/help":
             self._show_help()
         elif cmd == "/config":
@@ -171,7 +233,7 @@ class ChatUI:
         """Отправка сообщения модели"""
         if not self.chat_manager.current_chat:
             # Автоматически создаем чат
-            self.chat_manager.create_chat("Без названия", self.hyperprompt.__dict__)
+            self.chat_manager.create_chat("Без названия", self.hyperprompt.to_dict())
             self._update_status("Создан новый чат")
         
         # Добавляем сообщение пользователя
@@ -188,95 +250,184 @@ class ChatUI:
         
         self.generating = True
         self.current_response = ""
+        self._response_chunks = []
         
-        # Формирование промпта
-        messages = [{"role": m.role, "content": m.content} for m in self.chat_manager.get_messages()]
-        prompt = self.hyperprompt.format_prompt(messages)
-        
-        self._update_status("🤖 Генерация...")
+        # Снимок истории; промпт из него формируется уже в потоке генерации
+        history = list(self.chat_manager.get_messages())
         
         try:
+            await self._wait_for_model()
+            self._update_status("🤖 Генерация...")
+            self._begin_response()
+            
             # Генерация в отдельном потоке для неблокирующего UI
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, self._generate_sync, prompt)
+            # Пакеты токенов поток генерации сам передает в цикл событий;
+            # завершение executor-future приходит после всех пакетов
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._generate_sync, history, loop)
             
+            # Ответ собирается из частей один раз, без конкатенации на каждый токен
+            self.current_response = "".join(self._response_chunks)
             if self.current_response.strip():
                 self.chat_manager.add_message("assistant", self.current_response)
+            else:
+                self._discard_response()
         except Exception as e:
             self._add_to_history("system", f"Ошибка генерации: {e}")
         finally:
             self.generating = False
             self._update_status("Готов")
     
-    def _generate_sync(self, prompt: str):
-        """Синхронная генерация (выполняется в отдельном потоке)"""
-        for token in self.model_inference.generate(
-            prompt=prompt,
-            max_tokens=self.model_inference.metadata.get("max_tokens", 2048),
-            temperature=self.model_inference.metadata.get("temperature", 0.7),
-            top_p=self.model_inference.metadata.get("top_p", 0.95),
-            top_k=self.model_inference.metadata.get("top_k", 40),
-            stop_sequences=self.hyperprompt.stop_sequences,
-            stream=True
-        ):
-            if not self.generating:
-                break
+    def _reset_prompt_cache(self):
+        """Сбрасывает кэш токенов промпта модели при смене истории чата"""
+        if self.model_inference is not None:
+            self.model_inference.reset_prompt_cache()
+    
+    async def _wait_for_model(self):
+        """Дожидается окончания фоновой загрузки модели"""
+        if self.model_inference is None:
+            self._update_status("⏳ Загрузка модели...")
+            self.model_inference = await asyncio.wrap_future(self._inference_future)
+    
+    def _generate_sync(self, history: List, loop: asyncio.AbstractEventLoop):
+        """
+        Синхронная генерация (выполняется в отдельном потоке).
+        Здесь же формируется промпт, чтобы не занимать цикл событий UI
+        """
+        batch = []
+        batch_size = 1
+        last_flush = time.monotonic()
+        # Конец текста, который может оказаться началом стоп-последовательности
+        held = ""
+        try:
+            messages = [{"role": m.role, "content": m.content} for m in history]
+            prompt = self.hyperprompt.format_prompt(messages)
+            prefix = self.hyperprompt.format_prefix(messages)
             
-            self.current_response += token
-            # Обновляем UI в главном потоке
-            asyncio.run_coroutine_threadsafe(
-                self._update_response(token), 
-                asyncio.get_event_loop()
-            )
+            for token in self.model_inference.generate(
+                prompt=prompt,
+                max_tokens=self.model_inference.metadata.get("max_tokens", 2048),
+                temperature=self.model_inference.metadata.get("temperature", 0.7),
+                top_p=self.model_inference.metadata.get("top_p", 0.95),
+                top_k=self.model_inference.metadata.get("top_k", 40),
+                stop_sequences=self.hyperprompt.stop_sequences,
+                stream=True,
+                prefix=prefix
+            ):
+                if not self.generating:
+                    break
+                
+                # Стоп-последовательность обрезает ответ и останавливает генерацию
+                text = held + token
+                stop = self.hyperprompt.find_stop(text)
+                if stop is not None:
+                    held = text[:stop]
+                    break
+                keep = self.hyperprompt.stop_holdback(text)
+                text, held = text[:len(text) - keep], text[len(text) - keep:]
+                if not text:
+                    continue
+                
+                self._response_chunks.append(text)
+                batch.append(text)
+                
+                # Передаем пакет токенов в цикл событий UI одним колбэком
+                now = time.monotonic()
+                if len(batch) >= batch_size or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                    loop.call_soon_threadsafe(self._apply_token_batch, "".join(batch))
+                    batch = []
+                    batch_size = min(batch_size * 3, STREAM_MAX_BATCH)
+                    last_flush = now
+        finally:
+            if held:
+                self._response_chunks.append(held)
+                batch.append(held)
+            if batch:
+                loop.call_soon_threadsafe(self._apply_token_batch, "".join(batch))
+    
+    def _begin_response(self):
+        """Добавляет в историю заголовок ответа ассистента, части ответа дописываются после него"""
+        self._response_start = len(self.chat_history.text)
+        self._add_to_history("assistant", "")
+    
+    def _discard_response(self):
+        """Убирает из истории заголовок ответа, если модель ничего не сгенерировала"""
+        self._set_history(self.chat_history.text[:self._response_start])
     
-    async def _update_response(self, token: str):
-        """Обновление ответа в UI"""
-        # Добавляем токен к последнему сообщению assistant
-        lines = self.chat_history.text.split("\n")
-        if lines and "Assistant:" in lines[-1]:
-            lines[-1] += token
+    def _apply_token_batch(self, text: str):
+        """
+        Обновление ответа в UI: пакет дописывается в конец истории без разбиения на строки.
+        Буфер prompt_toolkit хранит неизменяемую строку, поэтому каждое обновление
+        все равно копирует весь текст истории - пакетирование токенов ограничивает число таких копий
+        """
+        self._set_history(self.chat_history.text + text)
+    
+    def _format_history(self, entries, text: str = "") -> str:
+        """
+        Дописывает сообщения (role, content) к тексту истории.
+        Части собираются в список и склеиваются один раз
+        """
+        parts = [text]
+        ends_with_newline = text.endswith("\n")
+        for role, content in entries:
+            if not ends_with_newline:
+                parts.append("\n")
+            parts.append(_ENTRY_HEADERS.get(role, "\n\n"))
+            parts.append(content)
+            ends_with_newline = content.endswith("\n") if content else True
+        
+        return "".join(parts)
+    
+    def _set_history(self, text: str, follow: bool = False):
+        """
+        Заменяет текст истории одним обновлением буфера (текст и курсор вместе).
+        К концу истории прокручивается, только если курсор был на последней строке,
+        т.е. пользователь не прокрутил историю вверх, или если follow=True.
+        Проверяется строка, а не позиция: прокрутка мышью сохраняет колонку курсора
+        """
+        buffer = self.chat_history.buffer
+        document = buffer.document
+        if follow or document.cursor_position_row >= document.line_count - 1:
+            cursor = len(text)
         else:
-            lines.append(f"Assistant: {token}")
-        
-        self.chat_history.text = "\n".join(lines)
-        self.chat_history.buffer.cursor_position = len(self.chat_history.text)
+            cursor = min(buffer.cursor_position, len(text))
+        buffer.set_document(Document(text, cursor), bypass_readonly=True)
     
     def _add_to_history(self, role: str, content: str):
         """Добавление сообщения в историю"""
-        prefix = {
-            "user": "👤 You:",
-            "assistant": "🤖 Assistant:",
-            "system": "⚙️ System:",
-        }
-        
-        text = self.chat_history.text
-        if not text.endswith("\n"):
-            text += "\n"
-        
-        text += f"\n{prefix.get(role, '')}\n{content}"
-        self.chat_history.text = text
-        self.chat_history.buffer.cursor_position = len(text)
+        self._set_history(self._format_history([(role, content)], self.chat_history.text))
+    
+    async def _ask(self, question: str) -> str:
+        """Ввод строки в терминале на время приостановленного UI"""
+        return await run_in_terminal(lambda: input(question).strip(), in_executor=True)
+    
+    async def _confirm_action(self, title: str, question: str) -> bool:
+        """Подтверждение действия (y/n)"""
+        answer = await self._ask(f"{title}: {question} [y/N] ")
+        return answer.lower() in ("y", "yes", "д", "да")
     
-    def _new_chat(self):
+    async def _new_chat(self):
         """Создание нового чата"""
-        title = prompt("Название чата: ", default=f"Чат {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+        default_title = f"Чат {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        title = await self._ask(f"Название чата [{default_title}]: ") or default_title
         if title:
-            self.chat_manager.create_chat(title, self.hyperprompt.__dict__)
-            self.chat_history.text = f"Создан новый чат: {title}\n"
+            self.chat_manager.create_chat(title, self.hyperprompt.to_dict())
+            self._reset_prompt_cache()
+            self._set_history(f"Создан новый чат: {title}\n", follow=True)
     
-    def _load_chat(self):
+    async def _load_chat(self):
         """Загрузка чата"""
         chats = self.chat_manager.get_chat_list()
         if not chats:
             self._add_to_history("system", "Нет сохраненных чатов")
             return
         
-        # Простой текстовый выбор (вместо radiolist)
-        self._add_to_history("system", "Доступные чаты:")
-        for i, chat in enumerate(chats[:10], 1):
-            self._add_to_history("system", f"  {i}. {chat['title']} ({chat['message_count']} сообщений)")
+        # Простой текстовый выбор (вместо radiolist), список выводится одним блоком
+        rows = "\n".join(f"  {i}. {UIComponents.format_chat_row(chat)}" for i, chat in enumerate(chats[:10], 1))
+        self._add_to_history("system", f"Доступные чаты:\n{rows}")
         
-        choice = prompt("Введите номер чата или ID: ")
+        # Ввод в терминале на время приостановленного UI
+        choice = await self._ask("Введите номер чата или ID: ")
         
         try:
             if choice.isdigit():
@@ -289,11 +440,12 @@ class ChatUI:
             else:
                 chat_id = choice
             
-            if self.chat_manager.load_chat(chat_id):
-                # Обновляем историю UI
-                self.chat_history.text = ""
-                for msg in self.chat_manager.get_messages():
-                    self._add_to_history(msg.role, msg.content)
+            self._update_status("⏳ Загрузка чата...")
+            if await self.chat_manager.load_chat_async(chat_id):
+                self._reset_prompt_cache()
+                # Обновляем историю UI одним присваиванием, а не по сообщению
+                text = self._format_history((msg.role, msg.content) for msg in self.chat_manager.get_messages())
+                self._set_history(text, follow=True)
                 self._update_status(f"Чат загружен: {self.chat_manager.current_chat.title}")
             else:
                 self._add_to_history("system", "Чат не найден")
@@ -309,71 +461,46 @@ class ChatUI:
         self.chat_manager.save_current_chat()
         self._update_status("Чат сохранен")
     
-    def _delete_chat(self):
+    async def _delete_chat(self):
         """Удаление чата"""
         if not self.chat_manager.current_chat:
             self._add_to_history("system", "Нет активного чата")
             return
         
-        if self.confirm_action("Удаление", f"Удалить чат '{self.chat_manager.current_chat.title}'?"):
+        if await self._confirm_action("Удаление", f"Удалить чат '{self.chat_manager.current_chat.title}'?"):
             chat_id = self.chat_manager.current_chat.id
+            title = self.chat_manager.current_chat.title
             if self.chat_manager.delete_chat(chat_id):
-                self.chat_history.text = f"Чат '{self.chat_manager.current_chat.title}' удален\n"
+                self._set_history(f"Чат '{title}' удален\n", follow=True)
                 self.chat_manager.current_chat = None
     
-    def _clear_chat(self):
+    async def _clear_chat(self):
         """Очистка чата"""
         if not self.chat_manager.current_chat:
             self._add_to_history("system", "Нет активного чата")
             return
         
-        if self.confirm_action("Очистка", "Очистить историю текущего чата?"):
+        if await self._confirm_action("Очистка", "Очистить историю текущего чата?"):
             self.chat_manager.clear_current_chat()
-            self.chat_history.text = "История чата очищена\n"
+            self._reset_prompt_cache()
+            self._set_history("История чата очищена\n", follow=True)
     
     def _show_help(self):
         """Показ помощи"""
-        help_text = """
-Доступные команды:
-  /new     - Создать новый чат
-  /load    - Загрузить существующий чат
-  /save    - Сохранить текущий чат
-  /delete  - Удалить чат
-  /clear   - Очистить историю текущего чата
-  /config  - Показать конфигурацию
-  /exit    - Выйти из приложения
-  /help    - Показать эту справку
-
-Горячие клавиши:
-  Ctrl+N   - Новый чат
-  Ctrl+L   - Загрузить чат
-  Ctrl+S   - Сохранить чат
-  Ctrl+H   - Помощь
-  Ctrl+C   - Прервать генерацию
-  Ctrl+Q   - Выход
-"""
-        self._add_to_history("system", help_text)
+        self._add_to_history("system", _HELP_TEXT)
     
     def _show_config(self):
         """Показ конфигурации"""
-        from config import MODEL_CONFIG
-        config_text = f"""
-Модель: {MODEL_CONFIG['model_path']}
-Max tokens: {MODEL_CONFIG['max_tokens']}
-Temperature: {MODEL_CONFIG['temperature']}
-Top-p: {MODEL_CONFIG['top_p']}
-Top-k: {MODEL_CONFIG['top_k']}
-"""
-        self._add_to_history("system", config_text)
+        self._add_to_history("system", _CONFIG_TEXT)
     
     def _update_status(self, text: str):
         """Обновление статусной строки"""
         self.status_bar.text = f"{text} | Ctrl+H - Справка"
     
-    def _exit_app(self):
+    async def _exit_app(self):
         """Выход из приложения"""
         if self.generating:
-            if not self.confirm_action("Выход", "Генерация в процессе. Выйти?"):
+            if not await self._confirm_action("Выход", "Генерация в процессе. Выйти?"):
                 return
         
         if self.chat_manager.current_chat:
@@ -18,6 +18,13 @@ style = Style.from_dict({
     "text-area": "bg:#1e2127 #abb2bf",
 })
 
+# Подписи ролей в истории чата
+ROLE_PREFIXES = {
+    "user": "👤 You:",
+    "assistant": "🤖 Assistant:",
+    "system": "⚙️ System:",
+}
+
 class UIComponents:
     """UI компоненты для TUI"""
     
@@ -43,18 +50,17 @@ class UIComponents:
         }
         reset = "\033[0m"
         
-        prefix = {
-            "user": "👤 You:",
-            "assistant": "🤖 Assistant:",
-            "system": "⚙️ System:",
-        }
-        
         color = colors.get(role, "")
-        pref = prefix.get(role, "")
+        pref = ROLE_PREFIXES.get(role, "")
         
         print(f"\n{color}{pref}{reset}")
         print(f"{content}")
     
+    @staticmethod
+    def format_chat_row(chat: Dict[str, Any]) -> str:
+        """Строка чата для списков выбора"""
+        return f"{chat['title']} ({chat['message_count']} сообщений)"
+    
     @staticmethod
     def select_chat(chats: List[Dict[str, Any]]) -> Optional[str]:
         """Диалог выбора чата"""
@@ -66,7 +72,7 @@ class UIComponents:
             ).run()
             return None
         
-        values = [(c["id"], f"{c['title']} ({c['message_count']} сообщений)") for c in chats]
+        values = [(c["id"], UIComponents.format_chat_row(c)) for c in chats]
         
         result = radiolist_dialog(
             title="Выберите чат",